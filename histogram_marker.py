@@ -3,34 +3,304 @@
 # Authors: Hari Prasad SV
 # License: AGPL
 
-from typing import Any, ClassVar, Dict, List, Optional, Union
+import operator
+from typing import Any, ClassVar, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from junifer.api.decorators import register_marker
 from junifer.markers import BaseMarker
-from junifer.utils import logger
+from junifer.utils import logger, raise_error
 from junifer.data import get_mask
-from nilearn.maskers import NiftiMasker
+from nilearn.image import resample_to_img
+
+try:
+    import numba
+except ImportError:  # pragma: no cover
+    numba = None
+
 
 __all__ = ["HistogramMarker"]
 
+# Inputs with fewer values than this are binned with np.histogram
+_SMALL_DATA_SIZE = 10_000
+# Masks resolved from the subject's own data rather than its grid
+_DATA_DEPENDENT_MASKS = {
+    "inherit",
+    "compute_background_mask",
+    "compute_epi_mask",
+}
+# Largest count the int32 bin counts can hold
+_INT32_MAX = np.iinfo(np.int32).max
+
+
+def _data_range(data: np.ndarray) -> Tuple[float, float]:
+    """Get the minimum and maximum of ``data``.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The flattened, non-empty data.
+
+    Returns
+    -------
+    float
+        The minimum.
+    float
+        The maximum.
+
+    """
+    return float(np.min(data)), float(np.max(data))
+
+
+def _histogram_range(data: np.ndarray) -> Tuple[float, float]:
+    """Get the histogram range of ``data`` like ``np.histogram`` does.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The flattened data.
+
+    Returns
+    -------
+    float
+        The lower edge of the range.
+    float
+        The upper edge of the range.
+
+    Raises
+    ------
+    ValueError
+        If ``data`` contains NaN or infinite values.
+
+    """
+    if data.size == 0:
+        return 0.0, 1.0
+    lo, hi = _data_range(data)
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        raise_error(f"autodetected range of [{lo}, {hi}] is not finite")
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return lo, hi
+
+
+def _bin_edges(
+    data: np.ndarray, lo: float, hi: float, bins: int
+) -> np.ndarray:
+    """Get the edges ``np.histogram`` counts ``data`` against.
+
+    The edges are computed in the precision of ``data``, e.g. float32 for
+    float32 data, so that values on or near an edge are compared with the
+    same edges as in ``np.histogram``.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The flattened data.
+    lo : float
+        The lower edge of the range.
+    hi : float
+        The upper edge of the range.
+    bins : int
+        The number of bins.
+
+    Returns
+    -------
+    np.ndarray
+        The bin edges.
+
+    """
+    dtype = np.result_type(lo, hi, data)
+    if np.issubdtype(dtype, np.integer):
+        dtype = np.result_type(dtype, float)
+    return np.linspace(lo, hi, bins + 1, dtype=dtype)
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _hist_uniform(
+        data: np.ndarray, edges: np.ndarray, n_chunks: int
+    ) -> np.ndarray:
+        """Count ``data`` in the equal-width bins delimited by ``edges``.
+
+        The data is split in ``n_chunks`` chunks, typically one per thread.
+        Each chunk is counted into its own row of bins and the rows are
+        summed at the end. The bin of a value is computed arithmetically
+        and then checked against ``edges``, as in ``np.histogram``. Values
+        outside the range are ignored and the upper edge falls in the last
+        bin. Counts are int32, so ``data`` must have at most ``2**31 - 1``
+        values.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            The flattened data.
+        edges : np.ndarray
+            The bin edges, see :func:`_bin_edges`.
+        n_chunks : int
+            The number of chunks to count in parallel.
+
+        Returns
+        -------
+        np.ndarray
+            The bin counts.
+
+        """
+        n = data.shape[0]
+        bins = edges.shape[0] - 1
+        lo = float(edges[0])
+        hi = float(edges[bins])
+        chunk_size = (n + n_chunks - 1) // n_chunks
+        inv_width = bins / (hi - lo)
+        local = np.zeros((n_chunks, bins), dtype=np.int32)
+        for c in numba.prange(n_chunks):
+            for i in range(c * chunk_size, min(n, (c + 1) * chunk_size)):
+                value = data[i]
+                if value >= edges[0] and value <= edges[bins]:
+                    k = int((float(value) - lo) * inv_width)
+                    if k >= bins:
+                        k = bins - 1
+                    # Fix the bin of values within rounding of an edge
+                    if value < edges[k]:
+                        k -= 1
+                    elif k < bins - 1 and value >= edges[k + 1]:
+                        k += 1
+                    local[c, k] += 1
+        hist = np.zeros(bins, dtype=np.int32)
+        for c in range(n_chunks):
+            hist += local[c]
+        return hist
+
+
+def _uniform_histogram(
+    data: np.ndarray, lo: float, hi: float, bins: int
+) -> np.ndarray:
+    """Count ``data`` in ``bins`` equal-width bins over ``[lo, hi]``.
+
+    Values outside the range are ignored. Uses the Numba kernel if numba is
+    installed and ``np.histogram`` otherwise, or if there are too many
+    values for int32 counts.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The flattened data.
+    lo : float
+        The lower edge of the range.
+    hi : float
+        The upper edge of the range.
+    bins : int
+        The number of bins.
+
+    Returns
+    -------
+    np.ndarray
+        The bin counts.
+
+    """
+    if numba is None or data.size > _INT32_MAX:
+        return np.histogram(data, bins=bins, range=(lo, hi))[0]
+    edges = _bin_edges(data, lo, hi, bins)
+    return _hist_uniform(data, edges, numba.get_num_threads())
+
+
+def _histogram(
+    data: np.ndarray,
+    bins: int,
+    hist_range: Optional[Tuple[float, float]] = None,
+) -> Tuple[np.ndarray, float, float]:
+    """Compute the histogram of ``data``.
+
+    Small inputs, e.g. parcel-aggregated vectors, go through
+    ``np.histogram``, where call overhead rather than the data dominates
+    and no kernel needs compiling. Larger inputs use the Numba kernel.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The flattened data.
+    bins : int
+        The number of bins.
+    hist_range : tuple of (float, float), optional
+        The fixed range of the bins. If None, the range of the data is used
+        (default None).
+
+    Returns
+    -------
+    np.ndarray
+        The bin counts.
+    float
+        The lower edge of the range.
+    float
+        The upper edge of the range.
+
+    """
+    if data.size < _SMALL_DATA_SIZE:
+        hist, bin_edges = np.histogram(data, bins=bins, range=hist_range)
+        return hist, float(bin_edges[0]), float(bin_edges[-1])
+    if hist_range is None:
+        lo, hi = _histogram_range(data)
+    else:
+        lo, hi = hist_range
+    return _uniform_histogram(data, lo, hi, bins), lo, hi
+
+
+def _unscaled_data(img: Any) -> Tuple[np.ndarray, float, float]:
+    """Get the flattened stored values of an image and their scaling.
+
+    For images backed by a nibabel array proxy with a positive slope, the
+    values are read as stored on disk (e.g. int16), without applying the
+    slope and intercept; otherwise they are read as float32, without
+    filling the image's data cache.
+
+    Parameters
+    ----------
+    img : nibabel image
+        The image.
+
+    Returns
+    -------
+    np.ndarray
+        The flattened values.
+    float
+        The slope mapping the values to physical units.
+    float
+        The intercept mapping the values to physical units.
+
+    """
+    dataobj = img.dataobj
+    if hasattr(dataobj, "get_unscaled"):
+        slope, inter = float(dataobj.slope), float(dataobj.inter)
+        if slope > 0:
+            return np.asanyarray(dataobj.get_unscaled()).ravel(), slope, inter
+    data = img.get_fdata(caching="unchanged", dtype=np.float32)
+    return data.ravel(), 1.0, 0.0
+
+
 @register_marker
 class HistogramMarker(BaseMarker):
     """Class for histogram marker.
 
     Parameters
     ----------
-    bins : positive int, optional
-        The number of equal-width bins in the given range (default 10).
+    bins : positive int
+        The number of equal-width bins in the given range.
     name : str, optional
         The name of the marker. If None, will use ``VBM_GM_HistogramMarker``
         (default None).
     masks : str, dict, list of (dict or str), or None, optional
         The masks to be used for computation (default None).
+    hist_range : tuple of (float, float), optional
+        The lower and upper range of the bins, e.g. ``(0, 1)`` for VBM_GM
+        probability maps. Values outside the range are ignored. A fixed
+        range saves the pass over the data that finds its range. If None,
+        the range of the data is used (default None).
 
     """
 
-    _DEPENDENCIES = {"nilearn","numpy"}
+    _DEPENDENCIES = {"nilearn", "numpy"} | (
+        {"numba"} if numba is not None else set()
+    )
 
     _MARKER_INOUT_MAPPINGS: ClassVar[Dict[str, Dict[str, str]]] = {
         "VBM_GM": {
@@ -43,12 +313,109 @@ class HistogramMarker(BaseMarker):
         self,
         bins: int,
         name: Optional[str] = None,
-        masks: Union[str, Dict, List[Union[Dict, str]], None] = None
+        masks: Union[str, Dict, List[Union[Dict, str]], None] = None,
+        hist_range: Optional[Tuple[float, float]] = None,
     ) -> None:
+        bins = operator.index(bins)
+        if bins <= 0:
+            raise_error(f"bins must be a positive int, got {bins}")
         self.bins = bins
         self.masks = masks
+        if hist_range is not None:
+            hist_range = (float(hist_range[0]), float(hist_range[1]))
+            if not hist_range[0] < hist_range[1]:
+                raise_error(
+                    "hist_range must be a (lower, upper) pair with "
+                    f"lower < upper, got {hist_range}"
+                )
+        self.hist_range = hist_range
+        # Column names only depend on the number of bins
+        self._hist_col_names = list(range(bins))
+        self._edge_col_names = list(range(bins + 1))
+        # Bin edges over [0, 1], rescaled to the histogram range
+        self._edge_template = np.linspace(0.0, 1.0, bins + 1)
+        # Last boolean mask and its key (mask spec and target grid)
+        self._mask_cache: Optional[Tuple[Tuple, np.ndarray]] = None
         super().__init__(on="VBM_GM", name=name)
 
+    def _get_mask_arr(
+        self,
+        input: Dict[str, Any],
+        extra_input: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:
+        """Get the boolean mask on the grid of the input image.
+
+        If the mask only depends on the grid of the input, the last
+        resolved mask is kept, so that it is only loaded, resampled and cast
+        to boolean once for consecutive inputs sharing a space, shape and
+        affine. Masks computed from the input data itself, inherited masks
+        and masks in native space are resolved on every call.
+
+        Parameters
+        ----------
+        input : dict
+            The VBM_GM data as dictionary.
+        extra_input : dict, optional
+            The other fields in the pipeline data object (default None).
+
+        Returns
+        -------
+        np.ndarray
+            The boolean mask.
+
+        """
+        t_input_img = input["data"]
+        key = None
+        if self._mask_is_cacheable(input):
+            key = (
+                repr(self.masks),
+                input.get("space"),
+                t_input_img.shape[:3],
+                tuple(t_input_img.affine.flatten()),
+            )
+            if self._mask_cache is not None and self._mask_cache[0] == key:
+                return self._mask_cache[1]
+        # Get tailored mask
+        mask_img = get_mask(
+            masks=self.masks, target_data=input, extra_input=extra_input
+        )
+        # Bring the mask to the input grid if needed
+        if mask_img.shape[:3] != t_input_img.shape[:3] or not np.allclose(
+            mask_img.affine, t_input_img.affine
+        ):
+            mask_img = resample_to_img(
+                mask_img, t_input_img, interpolation="nearest"
+            )
+        mask_arr = np.asarray(mask_img.dataobj) > 0
+        if key is not None:
+            self._mask_cache = (key, mask_arr)
+        return mask_arr
+
+    def _mask_is_cacheable(self, input: Dict[str, Any]) -> bool:
+        """Check whether the mask only depends on the grid of the input.
+
+        Parameters
+        ----------
+        input : dict
+            The VBM_GM data as dictionary.
+
+        Returns
+        -------
+        bool
+            Whether the resolved mask can be reused for other inputs on the
+            same grid.
+
+        """
+        # Native space masks are warped with subject-specific transforms
+        if input.get("space") == "native":
+            return False
+        masks = self.masks if isinstance(self.masks, list) else [self.masks]
+        for t_mask in masks:
+            names = t_mask.keys() if isinstance(t_mask, dict) else [t_mask]
+            if any(name in _DATA_DEPENDENT_MASKS for name in names):
+                return False
+        return True
+
     def compute(
         self,
         input: Dict[str, Any],
@@ -59,7 +426,9 @@ class HistogramMarker(BaseMarker):
         Parameters
         ----------
         input : dict
-            The VBM_GM data as dictionary.
+            The VBM_GM data as dictionary. The data can also be an array of
+            already extracted values, e.g. parcel-aggregated, in which case
+            it is binned as is and ``masks`` is not applied.
         extra_input : dict, optional
             The other fields in the pipeline data object (default None).
 
@@ -78,39 +447,55 @@ class HistogramMarker(BaseMarker):
         logger.debug("Computing histogram")
 
         t_input_img = input["data"]
+        if isinstance(t_input_img, np.ndarray):
+            # Values already extracted, e.g. by ParcelAggregation
+            data = np.asarray(t_input_img).ravel()
+            hist, lo, hi = _histogram(data, self.bins, self.hist_range)
         # Load mask if provided
-        if self.masks is not None:
-            logger.debug(f"Masking with {self.masks}")
-            #breakpoint()
-            # Get tailored mask
-            mask_img = get_mask(
-                masks=self.masks, target_data=input, extra_input=extra_input
-            )
-            
+        elif self.masks is not None:
+            logger.debug("Masking with %s", self.masks)
+            mask_arr = self._get_mask_arr(input, extra_input)
             # Apply the mask to the input image
             logger.debug("Masking")
-            masker = NiftiMasker(mask_img, target_affine=t_input_img.affine)
-            data = masker.fit_transform(t_input_img)
-            # Flatten the masked data for histogram computation
-            data = data.ravel()
+            data = t_input_img.get_fdata(
+                caching="unchanged", dtype=np.float32
+            )[mask_arr]
+            # Compute the histogram
+            hist, lo, hi = _histogram(data, self.bins, self.hist_range)
         else:
-            data = t_input_img.get_fdata().ravel()
-        logger.debug("computed masks")    
-        
-        # Compute the histogram
-        hist, bin_edges = np.histogram(
-            data,
-            bins=self.bins,
-        )
+            # Compute the histogram
+            n_voxels = np.prod(t_input_img.shape)
+            if self.hist_range is None and n_voxels >= _SMALL_DATA_SIZE:
+                # Bin the stored values over their own range and only scale
+                # the range for the edges, as the scaling is monotonic
+                data, slope, inter = _unscaled_data(t_input_img)
+                extrema = np.empty(0)
+                if data.size > 0:
+                    extrema = np.asarray(_data_range(data))
+                raw_lo, raw_hi = _histogram_range(extrema)
+                hist = _uniform_histogram(data, raw_lo, raw_hi, self.bins)
+                # Empty and constant data are padded in physical units
+                lo, hi = _histogram_range(extrema * slope + inter)
+            else:
+                data = t_input_img.get_fdata(
+                    caching="unchanged", dtype=np.float32
+                ).ravel()
+                hist, lo, hi = _histogram(data, self.bins, self.hist_range)
+        logger.debug("computed histogram")
+        bin_edges = self._edge_template * (hi - lo) + lo
+        bin_edges[-1] = hi
+        # Store counts as int32 whenever they fit
+        if hist.dtype != np.int32 and hist.sum() <= _INT32_MAX:
+            hist = hist.astype(np.int32)
 
         # Create the output dictionary
         return {
             "hist": {
                 "data": hist,
-                "col_names": list(range(hist.size)),
+                "col_names": self._hist_col_names,
             },
             "bin_edges": {
                 "data": bin_edges,
-                "col_names": list(range(bin_edges.size)),
+                "col_names": self._edge_col_names,
             },
         }
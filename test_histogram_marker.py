@@ -0,0 +1,345 @@
+"""Provide tests for HistogramMarker."""
+
+# Authors: Hari Prasad SV
+# License: AGPL
+
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pytest
+
+
+pytest.importorskip("junifer")
+nib = pytest.importorskip("nibabel")
+
+import histogram_marker  # noqa: E402
+from histogram_marker import HistogramMarker  # noqa: E402
+
+
+@pytest.fixture(params=["numba", "numpy"])
+def backend(
+    request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch
+) -> str:
+    """Select the binning backend.
+
+    The ``numpy`` backend hides numba to exercise the ``np.histogram``
+    fallback.
+
+    Parameters
+    ----------
+    request : pytest.FixtureRequest
+        The pytest request.
+    monkeypatch : pytest.MonkeyPatch
+        The pytest monkeypatch fixture.
+
+    Returns
+    -------
+    str
+        The name of the backend.
+
+    """
+    if request.param == "numba" and histogram_marker.numba is None:
+        pytest.skip("numba is not installed")
+    if request.param == "numpy":
+        monkeypatch.setattr(histogram_marker, "numba", None)
+    return request.param
+
+
+def _make_input(data: np.ndarray, **kwargs: Any) -> Dict[str, Any]:
+    """Wrap ``data`` in a VBM_GM input dictionary."""
+    return {"data": nib.Nifti1Image(data, np.eye(4), **kwargs), "space": "MNI"}
+
+
+def _assert_equal_histogram(
+    out: Dict[str, Any], data: np.ndarray, **kwargs: Any
+) -> None:
+    """Check the marker output against ``np.histogram``."""
+    hist, bin_edges = np.histogram(data, **kwargs)
+    np.testing.assert_array_equal(out["hist"]["data"], hist)
+    np.testing.assert_allclose(out["bin_edges"]["data"], bin_edges)
+    assert out["hist"]["data"].dtype == np.int32
+    assert out["hist"]["col_names"] == list(range(hist.size))
+    assert out["bin_edges"]["col_names"] == list(range(bin_edges.size))
+
+
+@pytest.mark.parametrize("size", [400, 30**3])
+def test_compute(backend: str, size: int) -> None:
+    """Test compute against np.histogram on small and large inputs.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    size : int
+        The number of voxels.
+
+    """
+    rng = np.random.default_rng(0)
+    data = rng.random(size).astype(np.float32).reshape(-1, 1, 1)
+    out = HistogramMarker(bins=50).compute(_make_input(data))
+    _assert_equal_histogram(out, data, bins=50)
+
+
+def test_compute_hist_range(backend: str) -> None:
+    """Test compute with a fixed range, ignoring out-of-range values.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+
+    """
+    rng = np.random.default_rng(0)
+    data = (rng.random((30, 30, 30)) * 1.4 - 0.2).astype(np.float32)
+    data[0, 0, 0] = np.nan
+    data[0, 0, 1] = np.inf
+    data[0, 0, 2] = 1.0
+    marker = HistogramMarker(bins=40, hist_range=(0, 1))
+    out = marker.compute(_make_input(data))
+    _assert_equal_histogram(out, data, bins=40, range=(0, 1))
+
+
+@pytest.mark.parametrize(
+    "low, high, slope, inter, bins",
+    [
+        (-300, 3000, 0.001, -0.5, 100),
+        (-1000, 3000, 1e-6, 1e4, 10),
+        (-1000, 3000, 0.001, 0.0, 256),
+    ],
+)
+def test_compute_unscaled(
+    backend: str,
+    tmp_path: Path,
+    low: int,
+    high: int,
+    slope: float,
+    inter: float,
+    bins: int,
+) -> None:
+    """Test compute on scaled int16 data read from disk.
+
+    The counts are checked against the stored values, which the scaling
+    maps monotonically and without rounding onto the bins.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    tmp_path : pathlib.Path
+        The path to the test directory.
+    low : int
+        The lowest stored value.
+    high : int
+        One more than the highest stored value.
+    slope : float
+        The scaling slope.
+    inter : float
+        The scaling intercept.
+    bins : int
+        The number of bins.
+
+    """
+    rng = np.random.default_rng(0)
+    data = rng.integers(low, high, (30, 30, 30)).astype(np.int16)
+    data.flat[:2] = low, high - 1
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_slope_inter(slope, inter)
+    nib.save(img, tmp_path / "vbm.nii.gz")
+    img = nib.load(tmp_path / "vbm.nii.gz")
+    out = HistogramMarker(bins=bins).compute({"data": img, "space": "MNI"})
+    hist, _ = np.histogram(data, bins=bins)
+    _, bin_edges = np.histogram(img.get_fdata(), bins=bins)
+    np.testing.assert_array_equal(out["hist"]["data"], hist)
+    np.testing.assert_allclose(out["bin_edges"]["data"], bin_edges)
+    assert out["hist"]["data"].sum() == data.size
+
+
+def test_compute_masked(
+    backend: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test compute with a mask.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    monkeypatch : pytest.MonkeyPatch
+        The pytest monkeypatch fixture.
+
+    """
+    rng = np.random.default_rng(0)
+    data = rng.random((30, 30, 30)).astype(np.float32)
+    mask = rng.random((30, 30, 30)) > 0.3
+    mask_img = nib.Nifti1Image(mask.astype(np.int8), np.eye(4))
+    monkeypatch.setattr(
+        histogram_marker, "get_mask", lambda **kwargs: mask_img
+    )
+    marker = HistogramMarker(bins=50, masks="GM_prob0.2")
+    out = marker.compute(_make_input(data))
+    _assert_equal_histogram(out, data[mask], bins=50)
+
+
+def _quantized_data(kind: str, size: int) -> np.ndarray:
+    """Make float32 data with many values on the bin edges."""
+    rng = np.random.default_rng(0)
+    if kind == "uint8":
+        # Probability map stored as uint8 / 255
+        return (rng.integers(0, 256, size, dtype=np.uint8) / 255).astype(
+            np.float32
+        )
+    # Values on a regular grid k * step + offset
+    return (rng.integers(0, 256, size) * (1 / 255) + 0.1).astype(np.float32)
+
+
+@pytest.mark.parametrize("kind", ["uint8", "grid"])
+@pytest.mark.parametrize("bins", [5, 17, 51, 255])
+@pytest.mark.parametrize("hist_range", [None, (0, 1)])
+def test_compute_quantized(
+    backend: str,
+    kind: str,
+    bins: int,
+    hist_range: Optional[Tuple[float, float]],
+) -> None:
+    """Test compute on quantized data against np.histogram.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    kind : str
+        The kind of quantized data.
+    bins : int
+        The number of bins.
+    hist_range : tuple of (float, float) or None
+        The fixed range of the bins.
+
+    """
+    data = _quantized_data(kind, 30**3)
+    marker = HistogramMarker(bins=bins, hist_range=hist_range)
+    out = marker.compute(_make_input(data.reshape(-1, 1, 1)))
+    _assert_equal_histogram(out, data, bins=bins, range=hist_range)
+    lo, hi = hist_range or (data.min(), data.max())
+    n_in_range = np.count_nonzero((data >= lo) & (data <= hi))
+    assert out["hist"]["data"].sum() == n_in_range
+
+
+@pytest.mark.parametrize("size", [0, 400, 30**3])
+def test_compute_constant(backend: str, size: int) -> None:
+    """Test compute on empty and constant inputs.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    size : int
+        The number of voxels.
+
+    """
+    data = np.full((size, 1, 1), 0.25, dtype=np.float32)
+    out = HistogramMarker(bins=10).compute(_make_input(data))
+    _assert_equal_histogram(out, data, bins=10)
+
+
+@pytest.mark.parametrize("size", [400, 30**3])
+@pytest.mark.parametrize("value", [np.nan, np.inf, -np.inf])
+@pytest.mark.parametrize("position", [0, -1])
+def test_compute_non_finite(
+    backend: str, size: int, value: float, position: int
+) -> None:
+    """Test compute raises on non-finite input without a range.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    size : int
+        The number of voxels.
+    value : float
+        The non-finite value.
+    position : int
+        The position of the non-finite value.
+
+    """
+    data = np.random.default_rng(0).random(size).astype(np.float32)
+    data[position] = value
+    with pytest.raises(ValueError, match="not finite"):
+        HistogramMarker(bins=10).compute(_make_input(data.reshape(-1, 1, 1)))
+
+
+@pytest.mark.parametrize("size", [400, 30**3])
+def test_compute_array_input(backend: str, size: int) -> None:
+    """Test compute on an array of extracted float64 values.
+
+    Parameters
+    ----------
+    backend : str
+        The binning backend.
+    size : int
+        The number of values.
+
+    """
+    data = np.random.default_rng(0).random(size)
+    # Values apart in float64 only, on either side of the 0.5 bin edge
+    data[:4] = 0.0, 1.0, *np.nextafter(0.5, [0.0, 1.0])
+    out = HistogramMarker(bins=20).compute({"data": data})
+    _assert_equal_histogram(out, data, bins=20)
+
+
+@pytest.mark.parametrize("bins", [0, -1, 2.5])
+def test_invalid_bins(bins: Any) -> None:
+    """Test invalid bins.
+
+    Parameters
+    ----------
+    bins : int or float
+        The invalid bins.
+
+    """
+    with pytest.raises((ValueError, TypeError)):
+        HistogramMarker(bins=bins)
+
+
+def test_invalid_hist_range() -> None:
+    """Test invalid hist_range."""
+    with pytest.raises(ValueError, match="hist_range"):
+        HistogramMarker(bins=10, hist_range=(1, 0))
+
+
+@pytest.mark.parametrize(
+    "masks, n_calls",
+    [
+        ("GM_prob0.2", 1),
+        ({"compute_brain_mask": {"threshold": 0.2}}, 1),
+        ("inherit", 2),
+        ([{"compute_epi_mask": {}}, {"threshold": 0.5}], 2),
+    ],
+)
+def test_mask_cache(
+    masks: Any, n_calls: int, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that only grid-dependent masks are reused.
+
+    Parameters
+    ----------
+    masks : str, dict or list
+        The mask spec.
+    n_calls : int
+        The expected number of mask resolutions for two inputs.
+    monkeypatch : pytest.MonkeyPatch
+        The pytest monkeypatch fixture.
+
+    """
+    calls = []
+    mask_img = nib.Nifti1Image(np.ones((5, 5, 5), np.int8), np.eye(4))
+
+    def _get_mask(**kwargs: Any) -> Any:
+        calls.append(kwargs)
+        return mask_img
+
+    monkeypatch.setattr(histogram_marker, "get_mask", _get_mask)
+    marker = HistogramMarker(bins=10, masks=masks)
+    data = np.random.default_rng(0).random((5, 5, 5)).astype(np.float32)
+    marker.compute(_make_input(data))
+    marker.compute(_make_input(data))
+    assert len(calls) == n_calls